@@ -0,0 +1,142 @@
+import importlib.util
+import os
+import zipfile
+
+import pytest
+from huggingface_hub import CommitOperationAdd, CommitOperationDelete, HfApi, constants
+
+from utils.push_to_hub import _create_commit, _get_commit_operations, _get_n_eval_envs, _pack_metrics_zip
+
+
+def test_pack_metrics_zip(tmp_path):
+    log_path = tmp_path / "logs"
+    repo_local_path = tmp_path / "repo"
+    log_path.mkdir()
+    repo_local_path.mkdir()
+
+    # Content does not matter, only how the file is archived
+    (log_path / "evaluations.npz").write_bytes(os.urandom(1024))
+    for idx in range(2):
+        (log_path / f"{idx}.monitor.csv").write_text("r,l,t\n" + "1.0,10,0.1\n" * 100)
+    # Not part of the metrics
+    (log_path / "model.zip").write_bytes(b"")
+
+    _pack_metrics_zip(log_path, repo_local_path)
+
+    with zipfile.ZipFile(repo_local_path / "train_eval_metrics.zip") as archive:
+        entries = {info.filename: info.compress_type for info in archive.infolist()}
+        assert archive.testzip() is None
+
+    assert entries == {
+        "evaluations.npz": zipfile.ZIP_STORED,
+        "0.monitor.csv": zipfile.ZIP_DEFLATED,
+        "1.monitor.csv": zipfile.ZIP_DEFLATED,
+    }
+
+
+def test_pack_metrics_zip_no_evaluations(tmp_path):
+    (tmp_path / "0.monitor.csv").write_text("r,l,t\n")
+
+    _pack_metrics_zip(tmp_path, tmp_path)
+
+    with zipfile.ZipFile(tmp_path / "train_eval_metrics.zip") as archive:
+        assert archive.namelist() == ["0.monitor.csv"]
+
+
+@pytest.mark.parametrize("cpu_count", [4, 16])
+def test_n_eval_envs(monkeypatch, cpu_count):
+    monkeypatch.setattr(os, "cpu_count", lambda: cpu_count)
+    n_eval_episodes = 10
+
+    # One env per episode (up to the number of CPUs) without video
+    assert _get_n_eval_envs(None, n_eval_episodes, False, {}) == min(n_eval_episodes, cpu_count)
+    # Single env when recording a video
+    assert _get_n_eval_envs(None, n_eval_episodes, True, {}) == 1
+    # User choice is respected
+    assert _get_n_eval_envs(3, n_eval_episodes, False, {}) == 3
+    assert _get_n_eval_envs(3, n_eval_episodes, True, {}) == 3
+    # HerReplayBuffer only supports one env
+    her_hyperparams = {"replay_buffer_class": "HerReplayBuffer"}
+    assert _get_n_eval_envs(None, n_eval_episodes, False, her_hyperparams) == 1
+    assert _get_n_eval_envs(3, n_eval_episodes, False, her_hyperparams) == 1
+
+
+@pytest.mark.parametrize("n_envs", [0, -1])
+def test_n_eval_envs_invalid(n_envs):
+    with pytest.raises(AssertionError):
+        _get_n_eval_envs(n_envs, 10, False, {})
+
+
+def test_n_eval_envs_her_warning(capsys):
+    her_hyperparams = {"replay_buffer_class": "HerReplayBuffer"}
+    _get_n_eval_envs(1, 10, False, her_hyperparams)
+    assert "ignoring n_envs" not in capsys.readouterr().out
+    _get_n_eval_envs(3, 10, False, her_hyperparams)
+    assert "ignoring n_envs=3" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("hf_transfer_installed", [True, False])
+@pytest.mark.parametrize("upload_fails", [False, True])
+def test_create_commit_hf_transfer(monkeypatch, hf_transfer_installed, upload_fails):
+    find_spec = importlib.util.find_spec
+
+    def fake_find_spec(name, *args, **kwargs):
+        if name == "hf_transfer":
+            return object() if hf_transfer_installed else None
+        return find_spec(name, *args, **kwargs)
+
+    monkeypatch.setattr(importlib.util, "find_spec", fake_find_spec)
+    monkeypatch.setattr(constants, "HF_HUB_ENABLE_HF_TRANSFER", False)
+
+    hf_transfer_during_commit = []
+
+    def create_commit(self, **kwargs):
+        hf_transfer_during_commit.append(constants.HF_HUB_ENABLE_HF_TRANSFER)
+        if upload_fails:
+            raise RuntimeError("Upload failed")
+
+    monkeypatch.setattr(HfApi, "create_commit", create_commit)
+
+    if upload_fails:
+        with pytest.raises(RuntimeError):
+            _create_commit(HfApi(), "orga/repo", [], "Initial commit")
+    else:
+        _create_commit(HfApi(), "orga/repo", [], "Initial commit")
+
+    assert hf_transfer_during_commit == [hf_transfer_installed]
+    # Previous value is restored
+    assert constants.HF_HUB_ENABLE_HF_TRANSFER is False
+
+
+def test_hf_transfer_read_at_upload_time():
+    # _create_commit() toggles huggingface_hub.constants, which has no effect
+    # when the upload modules keep their own copy of the flag (huggingface_hub < 0.25)
+    import huggingface_hub._commit_api
+    import huggingface_hub.lfs
+
+    assert not hasattr(huggingface_hub.lfs, "HF_HUB_ENABLE_HF_TRANSFER")
+    assert not hasattr(huggingface_hub._commit_api, "HF_HUB_ENABLE_HF_TRANSFER")
+
+
+@pytest.mark.parametrize("unzipped_model_on_hub", [False, True])
+def test_commit_operations(monkeypatch, tmp_path, unzipped_model_on_hub):
+    model_name = "ppo-CartPole-v1"
+    (tmp_path / f"{model_name}.zip").write_bytes(b"model")
+    (tmp_path / "README.md").write_text("Model card")
+
+    repo_files = [".gitattributes", "README.md", f"{model_name}.zip"]
+    if unzipped_model_on_hub:
+        repo_files += [f"{model_name}/data", f"{model_name}/policy.pth"]
+    monkeypatch.setattr(HfApi, "list_repo_files", lambda self, repo_id, **kwargs: repo_files)
+
+    operations = _get_commit_operations(HfApi(), "orga/repo", tmp_path, model_name)
+
+    added = {operation.path_in_repo for operation in operations if isinstance(operation, CommitOperationAdd)}
+    deleted = [operation for operation in operations if isinstance(operation, CommitOperationDelete)]
+    assert added == {f"{model_name}.zip", "README.md"}
+    if unzipped_model_on_hub:
+        assert len(deleted) == 1
+        assert deleted[0].path_in_repo == f"{model_name}/"
+        assert deleted[0].is_folder
+    else:
+        assert len(deleted) == 0
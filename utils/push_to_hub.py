@@ -1,16 +1,18 @@
 import argparse
 import glob
+import importlib.util
 import os
 import shutil
+import tempfile
 import zipfile
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pprint import pformat
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import torch as th
 import yaml
-from huggingface_hub import HfApi, Repository
+from huggingface_hub import CommitOperation, CommitOperationAdd, CommitOperationDelete, HfApi, constants
 from huggingface_hub.repocard import metadata_save
 from huggingface_sb3.push_to_hub import _evaluate_agent, _generate_replay, generate_metadata
 from stable_baselines3.common.base_class import BaseAlgorithm
@@ -18,13 +20,15 @@ from stable_baselines3.common.utils import set_random_seed
 from stable_baselines3.common.vec_env import VecEnv, unwrap_vec_normalize
 from wasabi import Printer
 
-import utils.import_envs  # noqa: F401 pylint: disable=unused-import
 from utils import ALGOS, create_test_env, get_saved_hyperparams
-from utils.exp_manager import ExperimentManager
 from utils.utils import StoreDict, get_model_path
 
 msg = Printer()
 
+# Use the LibYAML bindings when PyYAML was built with them
+YamlLoader = getattr(yaml, "CUnsafeLoader", yaml.UnsafeLoader)
+YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+
 
 def save_model_card(repo_dir: Path, generated_model_card: str, metadata: Dict[str, Any]) -> None:
     """Saves a model card for the repository.
@@ -42,6 +46,124 @@ def save_model_card(repo_dir: Path, generated_model_card: str, metadata: Dict[st
     metadata_save(readme_path, metadata)
 
 
+def _copy_config_files(log_path: Path, env_id: str, env_kwargs: Dict[str, Any], repo_local_path: Path) -> None:
+    """
+    Copy the config files (args, hyperparameters and env kwargs) to the local repository.
+
+    :param log_path: Path to where the model is saved in the zoo.
+    :param env_id: name of the environment
+    :param env_kwargs: Additional keyword arguments that were passed
+        to the environment.
+    :param repo_local_path: local repository path
+    """
+    args_path = log_path / env_id / "args.yml"
+    config_path = log_path / env_id / "config.yml"
+
+    shutil.copy(args_path, repo_local_path / "args.yml")
+    shutil.copy(config_path, repo_local_path / "config.yml")
+    with open(repo_local_path / "env_kwargs.yml", "w") as outfile:
+        yaml.dump(env_kwargs, outfile, Dumper=YamlDumper)
+
+
+def _pack_metrics_zip(log_path: Path, repo_local_path: Path) -> None:
+    """
+    Copy train/eval metrics (evaluations and monitor files) into a zip archive.
+
+    :param log_path: Path to where the model is saved in the zoo.
+    :param repo_local_path: local repository path
+    """
+    # evaluations.npz is stored as-is, the monitor files (plain text)
+    # are deflated with the fastest level to shrink the upload
+    evaluations_path = log_path / "evaluations.npz"
+    with zipfile.ZipFile(repo_local_path / "train_eval_metrics.zip", "w", compression=zipfile.ZIP_STORED) as archive:
+        if evaluations_path.is_file():
+            archive.write(evaluations_path, arcname=evaluations_path.name)
+        for monitor_file in log_path.glob("*.csv"):
+            archive.write(
+                monitor_file,
+                arcname=monitor_file.name,
+                compress_type=zipfile.ZIP_DEFLATED,
+                compresslevel=1,
+            )
+
+
+def _get_commit_operations(api: HfApi, repo_id: str, repo_local_path: Path, model_name: str) -> List[CommitOperation]:
+    """
+    Operations to push the content of the local repository to the Hub.
+    Previous versions of the zoo also uploaded the unzipped model ("{model_name}/" folder),
+    it is removed so it does not get out of sync with the new checkpoint.
+
+    :param api: Hugging Face Hub client
+    :param repo_id: id of the model repository from the Hugging Face Hub
+    :param repo_local_path: local repository path
+    :param model_name: name of the model zip file
+    :return: files to add (and folder to delete) in the repository
+    """
+    operations: List[CommitOperation] = [
+        CommitOperationAdd(path_in_repo=path.relative_to(repo_local_path).as_posix(), path_or_fileobj=str(path))
+        for path in repo_local_path.rglob("*")
+        if path.is_file()
+    ]
+    if any(path.startswith(f"{model_name}/") for path in api.list_repo_files(repo_id)):
+        operations.append(CommitOperationDelete(path_in_repo=f"{model_name}/", is_folder=True))
+    return operations
+
+
+def _create_commit(api: HfApi, repo_id: str, operations: List[CommitOperation], commit_message: str) -> None:
+    """
+    Push the operations to the Hub in a single commit,
+    using the Rust uploader (hf_transfer) when it is installed.
+    The previous hf_transfer setting is restored afterwards,
+    so downloads done by the rest of the zoo keep the default backend.
+
+    :param api: Hugging Face Hub client
+    :param repo_id: id of the model repository from the Hugging Face Hub
+    :param operations: files to add or delete in the repository
+    :param commit_message: commit message
+    """
+    hf_transfer_enabled = constants.HF_HUB_ENABLE_HF_TRANSFER
+    constants.HF_HUB_ENABLE_HF_TRANSFER = hf_transfer_enabled or importlib.util.find_spec("hf_transfer") is not None
+    try:
+        api.create_commit(
+            repo_id=repo_id,
+            operations=operations,
+            commit_message=commit_message,
+        )
+    finally:
+        constants.HF_HUB_ENABLE_HF_TRANSFER = hf_transfer_enabled
+
+
+def _get_n_eval_envs(
+    n_envs: Optional[int],
+    n_eval_episodes: int,
+    generate_video: bool,
+    hyperparams: Dict[str, Any],
+) -> int:
+    """
+    Number of environments used to evaluate the agent.
+    By default, one env per evaluation episode (up to the number of CPUs),
+    each one running in its own process (``SubprocVecEnv``),
+    or a single env when a video is recorded (all the envs would be rendered in it).
+
+    :param n_envs: number of environments requested by the user (None for the default)
+    :param n_eval_episodes: number of evaluation episodes
+    :param generate_video: whether a replay video is recorded using the evaluation env
+    :param hyperparams: saved hyperparameters of the agent
+    :return: number of environments
+    """
+    assert n_envs is None or n_envs >= 1, f"The number of environments must be at least 1, not {n_envs}"
+    # HerReplayBuffer only supports one env
+    if "HerReplayBuffer" in str(hyperparams.get("replay_buffer_class")):
+        if n_envs is not None and n_envs != 1:
+            msg.warn(f"HerReplayBuffer only supports one env, ignoring n_envs={n_envs}")
+        return 1
+    if n_envs is not None:
+        return n_envs
+    if generate_video:
+        return 1
+    return min(n_eval_episodes, os.cpu_count() or 1)
+
+
 def generate_model_card(
     algo_name: str,
     algo_class_name: str,
@@ -127,7 +249,6 @@ def package_to_hub(
     is_deterministic: bool = True,
     n_eval_episodes=10,
     token: Optional[str] = None,
-    local_repo_path="hub",
     video_length=1000,
     generate_video: bool = False,
 ):
@@ -160,7 +281,7 @@ def package_to_hub(
     :param commit_message: commit message
     :param is_deterministic: use deterministic or stochastic actions (by default: True)
     :param n_eval_episodes: number of evaluation episodes (by default: 10)
-    :param local_repo_path: local repository path
+    :param token: Hugging Face token, by default the one saved by ``huggingface-cli login``
     :param video_length: length of the video (in timesteps)
     """
 
@@ -173,90 +294,82 @@ def package_to_hub(
 
     organization, repo_name = repo_id.split("/")
 
-    # Step 1: Clone or create the repo
-    # Create the repo (or clone its content if it's nonempty)
-    api = HfApi()
+    # Step 1: Create the repo (no-op if it already exists)
+    # there is no need to clone it, files are uploaded in one commit at the end.
+    # The same client (and token) is used for all the requests,
+    # huggingface_hub keeps the HTTP connections alive between them
+    api = HfApi(token=token)
 
     repo_url = api.create_repo(
-        token=token,
         repo_id=repo_id,
         private=False,
         exist_ok=True,
     )
 
-    # Git pull
-    repo_local_path = Path(local_repo_path) / repo_name
-    repo = Repository(repo_local_path, clone_from=repo_url, use_auth_token=True)
-    repo.git_pull(rebase=True)
-
-    repo.lfs_track(["*.mp4"])
-
-    # Step 1: Save the model
-    model.save(repo_local_path / model_name)
-
-    # Retrieve VecNormalize wrapper if it exists
-    # we need to save the statistics
-    maybe_vec_normalize = unwrap_vec_normalize(eval_env)
-
-    # Save the normalization
-    if maybe_vec_normalize is not None:
-        maybe_vec_normalize.save(repo_local_path / "vec_normalize.pkl")
-        # Do not update the stats at test time
-        maybe_vec_normalize.training = False
-        # Reward normalization is not needed at test time
-        maybe_vec_normalize.norm_reward = False
-
-    # Unzip the model
-    with zipfile.ZipFile(repo_local_path / f"{model_name}.zip", "r") as zip_ref:
-        zip_ref.extractall(repo_local_path / model_name)
-
-    # Step 2: Copy config files
-    args_path = log_path / env_id / "args.yml"
-    config_path = log_path / env_id / "config.yml"
-
-    shutil.copy(args_path, repo_local_path / "args.yml")
-    shutil.copy(config_path, repo_local_path / "config.yml")
-    with open(repo_local_path / "env_kwargs.yml", "w") as outfile:
-        yaml.dump(env_kwargs, outfile)
-
-    # Copy train/eval metrics into zip
-    with zipfile.ZipFile(repo_local_path / "train_eval_metrics.zip", "w") as archive:
-        if os.path.isfile(log_path / "evaluations.npz"):
-            archive.write(log_path / "evaluations.npz", arcname="evaluations.npz")
-        for monitor_file in glob.glob(f"{log_path}/*.csv"):
-            archive.write(monitor_file, arcname=monitor_file.split(os.sep)[-1])
-
-    # Step 3: Evaluate the agent
-    mean_reward, std_reward = _evaluate_agent(model, eval_env, n_eval_episodes, is_deterministic, repo_local_path)
-
-    # Step 4: Generate a video
-    if generate_video:
-        _generate_replay(model, eval_env, video_length, is_deterministic, repo_local_path)
-        # Cleanup files after generation
-        # TODO: upstream to huggingface sb3
-        video_path = Path("test.mp4")
-        if video_path.is_file():
-            video_path.unlink()
-        json_path = list(glob.glob("*.meta.json"))
-        if len(json_path) > 0:
-            Path(json_path[0]).unlink()
-
-    # Step 5: Generate the model card
-    generated_model_card, metadata = generate_model_card(
-        algo_name,
-        algo_class_name,
-        organization,
-        env_id,
-        mean_reward,
-        std_reward,
-        hyperparams,
-        env_kwargs,
-    )
-
-    save_model_card(repo_local_path, generated_model_card, metadata)
-
-    msg.info(f"Pushing repo {repo_name} to the Hugging Face Hub")
-    repo.push_to_hub(commit_message=commit_message)
+    # Gather the files in a fresh temporary folder,
+    # so only the files produced by this run are uploaded
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        repo_local_path = Path(tmp_dir)
+
+        # Retrieve VecNormalize wrapper if it exists
+        # we need to save the statistics
+        maybe_vec_normalize = unwrap_vec_normalize(eval_env)
+
+        # Save the normalization
+        if maybe_vec_normalize is not None:
+            maybe_vec_normalize.save(repo_local_path / "vec_normalize.pkl")
+            # Do not update the stats at test time
+            maybe_vec_normalize.training = False
+            # Reward normalization is not needed at test time
+            maybe_vec_normalize.norm_reward = False
+
+        # Step 2: Copy config files, before the evaluation so missing files fail early
+        _copy_config_files(log_path, env_id, env_kwargs, repo_local_path)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Copy train/eval metrics into zip in the background,
+            # the model and the env are only used from this thread (they are not thread-safe)
+            metrics_future = executor.submit(_pack_metrics_zip, log_path, repo_local_path)
+
+            # Step 3: Evaluate the agent
+            mean_reward, std_reward = _evaluate_agent(model, eval_env, n_eval_episodes, is_deterministic, repo_local_path)
+
+            # Step 4: Generate a video
+            if generate_video:
+                _generate_replay(model, eval_env, video_length, is_deterministic, repo_local_path)
+                # Cleanup files after generation
+                # TODO: upstream to huggingface sb3
+                video_path = Path("test.mp4")
+                if video_path.is_file():
+                    video_path.unlink()
+                json_path = list(glob.glob("*.meta.json"))
+                if len(json_path) > 0:
+                    Path(json_path[0]).unlink()
+
+            # Step 5: Generate the model card
+            generated_model_card, metadata = generate_model_card(
+                algo_name,
+                algo_class_name,
+                organization,
+                env_id,
+                mean_reward,
+                std_reward,
+                hyperparams,
+                env_kwargs,
+            )
+
+            save_model_card(repo_local_path, generated_model_card, metadata)
+
+            # Re-raise any error that happened while packing the metrics
+            metrics_future.result()
+
+        msg.info(f"Pushing repo {repo_name} to the Hugging Face Hub")
+        # Step 6: Save the model
+        model.save(repo_local_path / model_name)
+
+        # Upload everything in a single commit, large files go through the LFS HTTP API
+        operations = _get_commit_operations(api, repo_id, repo_local_path, model_name)
+        _create_commit(api, repo_id, operations, commit_message)
 
     msg.info(f"Your model is pushed to the hub. You can view your model here: {repo_url}")
     return repo_url
@@ -269,7 +382,12 @@ if __name__ == "__main__":
     parser.add_argument("--algo", help="RL Algorithm", type=str, required=True, choices=list(ALGOS.keys()))
     parser.add_argument("-n", "--n-timesteps", help="number of timesteps", default=1000, type=int)
     parser.add_argument("--num-threads", help="Number of threads for PyTorch (-1 to use default)", default=-1, type=int)
-    parser.add_argument("--n-envs", help="number of environments", default=1, type=int)
+    parser.add_argument(
+        "--n-envs",
+        help="number of environments, one process each when > 1 "
+        "(default: one per evaluation episode up to the number of CPUs, 1 with video, always 1 with HER)",
+        type=int,
+    )
     parser.add_argument("--exp-id", help="Experiment ID (default: 0: latest, -1: no exp folder)", default=0, type=int)
     parser.add_argument("--verbose", help="Verbose mode (0: no output, 1: INFO)", default=1, type=int)
     parser.add_argument(
@@ -302,6 +420,12 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--commit-message", help="Commit message", default="Initial commit", type=str)
 
     args = parser.parse_args()
+
+    # Deferred until the arguments are valid: registering all envs
+    # and loading optuna (through the experiment manager) are slow
+    import utils.import_envs  # noqa: F401 pylint: disable=unused-import
+    from utils.exp_manager import ExperimentManager
+
     env_id = args.env
     algo = args.algo
 
@@ -317,12 +441,8 @@ if __name__ == "__main__":
 
     print(f"Loading {model_path}")
 
-    # Off-policy algorithm only support one env for now
     off_policy_algos = ["qrdqn", "dqn", "ddpg", "sac", "her", "td3", "tqc"]
 
-    if algo in off_policy_algos:
-        args.n_envs = 1
-
     set_random_seed(args.seed)
 
     if args.num_threads > 0:
@@ -335,12 +455,16 @@ if __name__ == "__main__":
     stats_path = os.path.join(log_path, env_id)
     hyperparams, stats_path = get_saved_hyperparams(stats_path, test_mode=True)
 
+    n_eval_episodes = 10
+    # Evaluate the episodes in parallel (in subprocesses) when no video is recorded
+    args.n_envs = _get_n_eval_envs(args.n_envs, n_eval_episodes, not args.no_render, hyperparams)
+
     # load env_kwargs if existing
     env_kwargs = {}
     args_path = os.path.join(log_path, env_id, "args.yml")
     if os.path.isfile(args_path):
         with open(args_path) as f:
-            loaded_args = yaml.load(f, Loader=yaml.UnsafeLoader)  # pytype: disable=module-attr
+            loaded_args = yaml.load(f, Loader=YamlLoader)
             if loaded_args["env_kwargs"] is not None:
                 env_kwargs = loaded_args["env_kwargs"]
     # overwrite with command line arguments
@@ -354,7 +478,8 @@ if __name__ == "__main__":
         seed=args.seed,
         log_dir=None,
         should_render=not args.no_render,
-        hyperparams=deepcopy(hyperparams),
+        # create_test_env() only removes top-level keys, a shallow copy is enough
+        hyperparams=hyperparams.copy(),
         env_kwargs=env_kwargs,
     )
 
@@ -394,9 +519,8 @@ if __name__ == "__main__":
         repo_id=repo_id,
         commit_message=args.commit_message,
         is_deterministic=deterministic,
-        n_eval_episodes=10,
+        n_eval_episodes=n_eval_episodes,
         token=None,
-        local_repo_path="hub",
         video_length=1000,
         generate_video=not args.no_render,
     )